@@ -11,31 +11,50 @@
 
     link to ~/.trinity/Autostart/ for autostart
 
-    Note: QSound is not working (broken ?) - so no audible notifications for now
+    Note: QSound is not working (broken ?) - so sounds are pre-decoded from .wav files (icon name + .wav in dir_sound)
+    and played by a worker thread via simpleaudio (if installed) or paplay/aplay, a desktop notification
+    (systray balloon) is shown if there is no sound or no audio backend. Alerts are raised only on signal level
+    changes confirmed by alert_debounce consecutive samples held for at least alert_dwell seconds.
 
     Note: There are intermittent artifacts on nvidia-340 xorg drivers.
 
     Note: there are visual artifacts (not specific to nvidia) caused probabbly by systray icon cache
     It works ok the 1st (+2nd) time but then is always starts with artifacts (workaround is to restart xorg)
 
-    TODO: debug why QSound() is not working
     TODO: read consfig from ini
     TODO: intermittent visual artifcats (only on multiple runs, the 1st/2nd time the icon is ok):
     TODO:        icon cache clear-up [/var/tmp/kdecache-robert/icon-cache.kcache] ? no, it doesn't help
     TODO:        icon cache clear-up [/var/tmp/tdecache-robert/icon-cache.kcache] ? no, it doesn't help
     TODO: open minimalistic web browser with dd-wrt info page from right-click menu entry
-    TODO: store long term statistics and provide signal strength plot
+    TODO: provide signal strength plot (from rollups)
+
+    Long term statistics: each sample is added to per device rollups (min/max/mean/percentiles/outage seconds
+    per minute, hour and day) in sqlite db (see wifi_rollup.py for report), disabled in replay unless --db is used.
+    Samples are recorded to compressed columnar history file (see wifi_history.py for export/import), disabled
+    in replay unless --history is used.
+
+    Replay (render path benchmark): --replay [file] feeds recorded samples (history file or json lines, optional
+    't' timestamp in seconds) or the built-in test table through update() at --speedup times the recorded rate (0 = as fast
+    as possible) and prints per-update cpu time, setIcon/setToolTip call counts and event loop latency.
+    Runs offscreen (QT_QPA_PLATFORM=offscreen) so it works headless.
 
 """
 
-import sys, os, re
+import sys, os, re, json, time, argparse, wave, queue, threading, shutil, subprocess, signal, sqlite3, warnings
 
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QSystemTrayIcon, QApplication, QMenu, QStyle
 from PyQt5.QtGui import QIcon
-from PyQt5.QtMultimedia import QSound
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
+from wifi_rollup import Rollup
+from wifi_history import HistoryWriter, samples, is_history
+
+# optional audio backend (fallback to paplay/aplay)
+try:
+    import simpleaudio
+except ImportError:
+    simpleaudio = None
 
 DBG = 0
 
@@ -44,9 +63,96 @@ def dbg_print(str):
     if DBG: print(str)
 
 
+class SignalAlert:
+    """ signal level change detection - debounce (consecutive samples) and minimum dwell time (seconds) """
+
+    def __init__(self, debounce=2, dwell=0):
+        """ init """
+        self.debounce, self.dwell = debounce, dwell
+        # confirmed signal table entry, candidate entry (changed level) with sample count and start time
+        self.entry = None
+        self.candidate, self.count, self.since = None, 0, 0
+
+    def feed(self, entry, now):
+        """ process signal table entry of actual sample at time now - return entry if alert is to be raised """
+        # the 1st sample sets the level (no alert)
+        if self.entry is None:
+            self.entry = entry
+            return None
+        # level unchanged (or back to confirmed level) - drop the candidate
+        if entry is self.entry:
+            self.candidate, self.count = None, 0
+            return None
+        # new candidate level
+        if entry is not self.candidate:
+            self.candidate, self.count, self.since = entry, 0, now
+        self.count += 1
+        # wait until confirmed by debounce samples and dwell time
+        if self.count < self.debounce or now - self.since < self.dwell:
+            return None
+        self.entry, self.candidate, self.count = entry, None, 0
+        return entry
+
+
+class SoundPlayer(threading.Thread):
+    """ plays pre-decoded sounds of signal table entries off the GUI thread (an entry waiting for the one
+        playing is replaced by newer one), failed(entry) is called (from the worker thread) if playback fails """
+
+    # wave sample width -> paplay/aplay raw format
+    FORMAT = {1: ('u8', 'U8'), 2: ('s16le', 'S16_LE'), 3: ('s24le', 'S24_3LE'), 4: ('s32le', 'S32_LE')}
+
+    def __init__(self, failed):
+        """ init - select audio backend """
+        super().__init__(daemon=True)
+        self.failed = failed
+        self.queue = queue.Queue(maxsize=1)
+        self.backend = 'simpleaudio' if simpleaudio else \
+            next((cmd for cmd in ('paplay', 'aplay') if shutil.which(cmd)), None)
+        dbg_print('SoundPlayer() backend=%s' % self.backend)
+
+    def play(self, entry):
+        """ non-blocking play request - return False if sound can't be played (no backend) """
+        if not self.backend: return False
+        if not self.is_alive(): self.start()
+        # drop the pending (stale) sound, the only producer is the GUI thread so there is room then
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put_nowait(entry)
+        return True
+
+    def run(self):
+        """ worker thread - play queued sounds """
+        while True:
+            entry = self.queue.get()
+            try:
+                self._play(entry['sound'])
+            except Exception as e:
+                dbg_print('SoundPlayer.run() error=%s' % e)
+                self.failed(entry)
+
+    def _play(self, s):
+        """ play sound s (blocking) """
+        if self.backend == 'simpleaudio':
+            simpleaudio.play_buffer(s['frames'], s['channels'], s['width'], s['rate']).wait_done()
+            return
+        fmt = self.FORMAT[s['width']]
+        if self.backend == 'paplay':
+            cmd = ['paplay', '--raw', '--format=' + fmt[0], '--channels=%d' % s['channels'], '--rate=%d' % s['rate']]
+        else:
+            cmd = ['aplay', '-q', '-t', 'raw', '-f', fmt[1], '-c', str(s['channels']), '-r', str(s['rate'])]
+        res = subprocess.run(cmd, input=s['frames'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if res.returncode:
+            raise OSError('%s failed (%d): %s' % (cmd[0], res.returncode, res.stderr.decode(errors='replace').strip()))
+
+
 class SystemTrayIcon(QSystemTrayIcon):
     """ system tray icon showing wifi signal strength on remore device """
 
+    # sound of signal table entry failed to play (emitted from sound player thread)
+    soundFailed = pyqtSignal(object)
+
     def __init__(self, icon, parent=None):
         """ init"""
         # parent
@@ -64,11 +170,22 @@ class SystemTrayIcon(QSystemTrayIcon):
         #
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.update)
+        # render path counters (setIcon/setToolTip calls, calls with unchanged value)
+        self.stats = {'setIcon': 0, 'setIcon_same': 0, 'setToolTip': 0, 'setToolTip_same': 0, 'alert': 0}
+        # audible notifications
+        self.player = SoundPlayer(self.soundFailed.emit)
+        self.soundFailed.connect(self.notify)
 
     def exit(self):
         """ exit has been pressed """
         QApplication.quit()
 
+    def close(self):
+        """ application quits - flush statistics """
+        if self.rollup: self.rollup.close()
+        self.record(None, None)
+        self.rollup = None
+
     def autoupdate(self, sec=None):
         """ initiate auto-refresh - default by device config, cen be overrriden by sec seconds """
         # update and show icon
@@ -84,16 +201,28 @@ class SystemTrayIcon(QSystemTrayIcon):
         path = '/'.join([dir, name + ext])
         return QIcon(path) if os.path.exists(path) else None
 
-    def _load_sound(self, dir, name, ext=['.ogg', '.mp3', '.wav']):
-        """ load resources - sound file from dir identified by name, try ext extensions (the first wins) """
-        dirname = '/'.join([dir, name])
-        for e in ext:
-            path = dirname + e
-            if os.path.exists(path):
-                return QSound(path)
-        return None
+    def _load_sound(self, dir, name, ext='.wav'):
+        """ load resources - sound from dir identified by name with extension ext, pre-decoded to pcm frames
+            (None for unsupported wav file - the alert falls back to desktop notification) """
+        path = '/'.join([dir, name + ext])
+        if not os.path.exists(path): return None
+        try:
+            w = wave.open(path, 'rb')
+        except (wave.Error, EOFError) as e:
+            dbg_print('_load_sound(%s) error=%s' % (path, e))
+            return None
+        with w:
+            if w.getsampwidth() not in SoundPlayer.FORMAT:
+                dbg_print('_load_sound(%s) unsupported sample width %d' % (path, w.getsampwidth()))
+                return None
+            return {
+                'channels': w.getnchannels(),
+                'width': w.getsampwidth(),
+                'rate': w.getframerate(),
+                'frames': w.readframes(w.getnframes())
+            }
 
-    def cfg_signal_table(self, levelstr, dir, ext='.png', sep=':,'):
+    def cfg_signal_table(self, levelstr, dir, dir_sound, ext='.png', sep=':,'):
         """ build configurable signal table - signal_level:icon_name, ... from string from config file """
         self.signal = []
         for lvl_txt in levelstr.strip().split(sep[1]):
@@ -107,7 +236,7 @@ class SystemTrayIcon(QSystemTrayIcon):
                 # preloaded icon resource
                 'icon':  self._load_icon(dir, txt),
                 # preloaded audible notification
-                'sound': self._load_sound(dir, txt)
+                'sound': self._load_sound(dir_sound, txt)
             }
             self.signal.append(item)
             dbg_print('cfg_signal_table() lvl_txt=%s item=%s' % (lvl_txt, item))
@@ -115,21 +244,37 @@ class SystemTrayIcon(QSystemTrayIcon):
 
     def get_entry_for_level(self, level):
         """ get signal table entry for signal level """
-        entry = None
+        # levels below the table fall to the lowest signal entry (negative levels are for error conditions)
+        entry = [ tab for tab in self.signal if tab['level'] >= 0 ][0]
         for tab in self.signal:
+            if tab['level'] < 0: continue
             if level < tab['level']: break
             entry = tab
         dbg_print('get_entry_for_level(%d) -> %s' % (level, entry))
         return entry
 
-    def get_icon_for_signal(self, txt):
-        """ get icon for signal text txt (used for error when level is not available) """
-        return [ i['icon'] for i in self.signal if i['signal'] == txt ][0]
+    def get_entry_for_signal(self, txt):
+        """ get signal table entry for signal text txt (used for error when level is not available) """
+        return [ i for i in self.signal if i['signal'] == txt ][0]
 
     def cfg_device(self, device):
         """ configure device to monitor """
         self.device = device
-        self.cfg_signal_table(device['signal_icon'], device['dir_icon'])
+        self.cfg_signal_table(device['signal_icon'], device['dir_icon'], device['dir_sound'])
+        self.alerts = SignalAlert(device['alert_debounce'], device['alert_dwell'])
+        self.rollup = None
+        if device['db']:
+            # short db lock timeout - never stall the poll (minutes are retried when db is busy)
+            try:
+                self.rollup = Rollup(device['db'], device['url'], device['update_interval'], timeout=0.1)
+            except (sqlite3.Error, OSError) as e:
+                warnings.warn('statistics disabled: %s' % e)
+        self.history = None
+        if device['history']:
+            try:
+                self.history = HistoryWriter(device['history'], device['url'])
+            except OSError as e:
+                warnings.warn('history recording disabled: %s' % e)
 
     def check_device(self, device):
         """ get data from monitored (remote) device """
@@ -171,26 +316,70 @@ class SystemTrayIcon(QSystemTrayIcon):
             res = self.callculate(res)
             tooltip = self.device['tooltip'] % res
             entry = self.get_entry_for_level(res[self.device['tab_key']])
-            #self.play_sound(entry['sound'])
-            icon = entry['icon']
         else:
             # error 'signal':'nocon', 'desc':description
-            icon = self.get_icon_for_signal(res['signal'])
+            entry = self.get_entry_for_signal(res['signal'])
             tooltip = self.device['tooltip_error'] % res
+        icon = entry['icon']
         # update icon and tooiltip
         dbg_print('update() res=%s' % res)
         dbg_print('update() icon=%s tooltip=%s' % (icon, tooltip))
         self.setIcon(icon)
         self.setToolTip(tooltip)
-
-    def play_sound(self, sound):
-        """ audible notification """
-        if sound: sound.play()
+        # alert on signal level change (sample time 't' is present in replayed data)
+        now = res.get('t', time.time())
+        self.alert(entry, now)
+        # long term statistics
+        if self.rollup: self.rollup.add(res, now)
+        self.record(res, now)
+
+    def setIcon(self, icon):
+        """ set systray icon - count calls for replay statistics """
+        self.stats['setIcon'] += 1
+        if icon is getattr(self, '_icon', None): self.stats['setIcon_same'] += 1
+        self._icon = icon
+        super().setIcon(icon)
+
+    def setToolTip(self, tooltip):
+        """ set systray tooltip - count calls for replay statistics """
+        self.stats['setToolTip'] += 1
+        if tooltip == getattr(self, '_tooltip', None): self.stats['setToolTip_same'] += 1
+        self._tooltip = tooltip
+        super().setToolTip(tooltip)
+
+    def record(self, res, now):
+        """ record sample to history file (res None - flush and stop), recording is disabled on error """
+        if not self.history: return
+        try:
+            if res is None: self.history.close()
+            else: self.history.append(res, now)
+        except (OSError, ValueError) as e:
+            warnings.warn('history recording disabled: %s' % e)
+            res = None
+        if res is None: self.history = None
+
+    def alert(self, entry, now):
+        """ alert on confirmed signal level change - sound or desktop notification (never blocks) """
+        entry = self.alerts.feed(entry, now)
+        if entry is None: return
+        self.stats['alert'] += 1
+        dbg_print('alert() signal=%s' % entry['signal'])
+        if not self.play_sound(entry): self.notify(entry)
+
+    def notify(self, entry):
+        """ desktop notification (systray balloon) for signal table entry """
+        icon = entry['icon'] if entry['icon'] else QIcon()
+        self.showMessage(self.device['alert_title'], self.device['alert_message'] % entry, icon,
+                         self.device['alert_timeout'] * 1000)
+
+    def play_sound(self, entry):
+        """ audible notification of signal table entry (played by worker thread) - return False if not played """
+        return self.player.play(entry) if entry['sound'] else False
 
     def test_data(self, data=None):
         """ diagnostic data for self-test """
         # initiate data if provided
-        if data:
+        if data is not None:
             self.data, self.data_idx = data, 0
             return
         # get actual entry
@@ -200,13 +389,69 @@ class SystemTrayIcon(QSystemTrayIcon):
         # return diag entry
         return d
 
-
-def main(app):
+    def replay(self, data, speedup=1.0, count=None):
+        """ replay samples through update() - speedup times faster than recorded rate (0 = as fast as possible) """
+        # sample interval [seconds] from recorded timestamps ('t' key) or from device config
+        t = [ d['t'] for d in data if 't' in d ]
+        interval = (t[-1] - t[0]) / (len(t) - 1) if len(t) > 1 else self.device['update_interval']
+        self.replay_interval = interval / speedup if speedup > 0 else 0
+        self.replay_count = len(data) if count is None else count
+        self.replay_cpu, self.replay_latency = [], []
+        self.test_data(data)
+        self.show()
+        # first update right away, then chained single-shot timer to measure event loop latency
+        self.replay_start = self.replay_due = time.monotonic()
+        QTimer.singleShot(0, self._replay_step)
+
+    def _replay_step(self):
+        """ replay - one update (measure latency of the timer and cpu time of the update) """
+        self.replay_latency.append(time.monotonic() - self.replay_due)
+        cpu = time.process_time()
+        self.update()
+        self.replay_cpu.append(time.process_time() - cpu)
+        # schedule next update or finish
+        if len(self.replay_cpu) >= self.replay_count:
+            print(self.replay_report())
+            QApplication.quit()
+            return
+        # precise timer (the default coarse one may fire up to 5% early), latency against the rounded delay
+        delay = round(self.replay_interval * 1000)
+        self.replay_due = time.monotonic() + delay / 1000
+        QTimer.singleShot(delay, Qt.PreciseTimer, self._replay_step)
+
+    def replay_report(self):
+        """ replay - statistics summary """
+        def ms(vals, q):
+            # q-quantile of vals in ms
+            return sorted(vals)[min(len(vals) - 1, int(q * len(vals)))] * 1000
+        n, wall = len(self.replay_cpu), time.monotonic() - self.replay_start
+        lines = [
+            'updates: %d in %.3fs (%.1f/s, interval %.3fs)' % (n, wall, n / wall if wall else 0, self.replay_interval),
+            'cpu/update [ms]: mean %.3f p50 %.3f p95 %.3f max %.3f' % (
+                sum(self.replay_cpu) / n * 1000, ms(self.replay_cpu, .5), ms(self.replay_cpu, .95), max(self.replay_cpu) * 1000),
+            'latency [ms]: mean %.3f p50 %.3f p95 %.3f max %.3f' % (
+                sum(self.replay_latency) / n * 1000, ms(self.replay_latency, .5), ms(self.replay_latency, .95),
+                max(self.replay_latency) * 1000),
+            'setIcon: %(setIcon)d (unchanged %(setIcon_same)d) setToolTip: %(setToolTip)d (unchanged %(setToolTip_same)d)'
+            ' alerts: %(alert)d' % self.stats
+        ]
+        return '\n'.join(lines)
+
+
+def load_replay(path):
+    """ load replay samples - history file or json dict per line (check_device() result keys, optional 't') """
+    if is_history(path): return list(samples(path))
+    with open(path) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+
+def main(app, args):
     """ main - instatiate app, read/process config and execute """
 
     # config
     dir_app = os.path.dirname(os.path.realpath(sys.argv[0]))
     dir_ico = dir_app + '/icon/128'
+    dir_snd = dir_app + '/sound'
 
     # default icon
     style = app.style()
@@ -245,6 +490,16 @@ def main(app):
         'signal_icon': signal_icon,
         # relative directory with icon files
         'dir_icon': dir_ico,
+        # relative directory with sound files (wav)
+        'dir_sound': dir_snd,
+        # alert on signal level change confirmed by number of consecutive samples
+        'alert_debounce': 2,
+        # alert on signal level change held for at least [seconds]
+        'alert_dwell': 15,
+        # alert notification (if sound is not available) - title, message (signal table keys), timeout [seconds]
+        'alert_title': 'WiFi',
+        'alert_message': 'signal %(signal)s',
+        'alert_timeout': 5,
         # ok tooltip
         # 'tooltip': "SNR: %(SNR)s / SN: %(SN)d / Q: %(Q)d%%",
         'tooltip': "SNR: %(SNR)s / Q: %(Q)d%%",
@@ -257,9 +512,25 @@ def main(app):
         # error message - url error - supported keys: errno, strerror
         'url_error': 'url %(strerror)s',
         # update frequency [seconds]
-        'update_interval': 10
+        'update_interval': 10,
+        # statistics (rollups) sqlite db, empty to disable
+        'db': os.path.expanduser('~/.local/share/SysTray/systray-wifi-icon.db'),
+        # recorded samples (history file), empty to disable
+        'history': os.path.expanduser('~/.local/share/SysTray/systray-wifi-icon.wsh')
     }
+    # replay doesn't touch statistics/history unless provided
+    for key in ('db', 'history'):
+        if getattr(args, key) is not None or args.replay is not None:
+            device[key] = getattr(args, key)
     wifiIcon.cfg_device(device)
+    app.aboutToQuit.connect(wifiIcon.close)
+    # logout/shutdown (SIGTERM, SIGHUP) - quit so statistics/history are flushed
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, lambda signum, frame: QApplication.quit())
+    # python signal handlers run only when the interpreter gets control from qt event loop
+    wakeup = QTimer(wifiIcon)
+    wakeup.timeout.connect(lambda: None)
+    wakeup.start(500)
 
     # execute diagnostic test without quering remote device
     tdata = [
@@ -275,6 +546,13 @@ def main(app):
     ]
     # wifiIcon.test_data(tdata)
 
+    # replay recorded (or test) samples and exit
+    if args.replay is not None:
+        data = load_replay(args.replay) if args.replay else tdata
+        if not data: return sys.exit('replay: no samples in %s' % args.replay)
+        wifiIcon.replay(data, args.speedup, args.count)
+        return sys.exit(app.exec_())
+
     # run
     wifiIcon.autoupdate()
     return sys.exit(app.exec_())
@@ -284,6 +562,19 @@ def main(app):
 #
 if __name__ == '__main__':
 
+    # command line (unknown arguments are passed to qt)
+    parser = argparse.ArgumentParser(description='systray icon showing wifi signal strength on remote device')
+    parser.add_argument('--replay', nargs='?', const='', metavar='FILE',
+                        help='replay samples from json lines FILE (default: built-in test table) and print statistics')
+    parser.add_argument('--speedup', type=float, default=0, help='replay speed-up, 0 = as fast as possible')
+    parser.add_argument('--count', type=int, help='number of replayed updates (default: all samples)')
+    parser.add_argument('--db', help='statistics (rollups) sqlite db')
+    parser.add_argument('--history', help='history file (recorded samples)')
+    args, qt_args = parser.parse_known_args()
+
+    # replay runs headless
+    if args.replay is not None: os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
     # application
-    app = QApplication(sys.argv[1:])
-    main(app)
+    app = QApplication(sys.argv[:1] + qt_args)
+    main(app, args)
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+
+"""
+    Signal history - compressed columnar storage of wifi signal samples (recording, export/import)
+
+    The file is a sequence of blocks (one device per block) after the file magic. Block header:
+
+        magic 'WBLK', rows, t0, t1 (min/max timestamp), device length, payload length, crc32 of payload
+
+    followed by the device id (url) and zlib compressed payload of columns:
+
+        dt      int32   timestamp deltas [seconds] (the 1st one from t0, timestamp = t0 + running sum)
+        status  uint8   index in STATUS (ok, nocon, error) - values of non-ok samples repeat the previous ones
+        signal  uint8   deltas mod 256 of int8 values (running sum mod 256 reinterpreted as int8)
+        noise   uint8   -"-
+        SNR     uint8   -"-
+        Q10     uint16  deltas mod 65536 of int16 values
+
+    Block headers are scanned in a memory-mapped file, so device/time filtering skips payloads without
+    decompressing them. Columns are decoded to typed arrays (numpy arrays if numpy is installed),
+    not to Python objects per sample. The recorder writes a block per hour (at least every 10 minutes),
+    export re-blocks per day (larger blocks compress better).
+
+    A torn block (crash during append) is cut off before the next append, readers stop at a truncated
+    block and skip blocks with crc error (with a warning).
+
+    usage: wifi_history.py info|csv|export|import src [dst] [--device url] [--since date] [--until date]
+"""
+
+import os, mmap, zlib, struct, time, calendar, argparse, warnings
+from array import array
+from itertools import accumulate, compress
+
+# optional - decode columns to numpy arrays
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# file magic
+MAGIC = b'WSH1'
+
+# block header - magic, rows, t0, t1 (min, max timestamp), device length, payload length, crc32
+BLOCK = struct.Struct('<4sIqqHII')
+BLOCK_MAGIC = b'WBLK'
+
+# sample status
+STATUS = ('ok', 'nocon', 'error')
+
+# columns - name, array type of stored (delta) values, array type of decoded values
+COLUMNS = (('dt', 'i', 'q'), ('status', 'B', 'B'),
+           ('signal', 'B', 'b'), ('noise', 'B', 'b'), ('SNR', 'B', 'b'), ('Q10', 'H', 'h'))
+
+# rows per block - recorder (1 hour at 10 s), export (1 day at 10 s)
+BLOCK_ROWS = 360
+EXPORT_ROWS = 8640
+
+# recorder - max time [seconds] samples are buffered
+FLUSH_SECONDS = 600
+
+
+def encode_block(device, cols):
+    """ encode block - cols {name: sequence of values} (t instead of dt) -> bytes """
+    t = cols['t']
+    # timestamps need not be ordered (merged imports, clock steps) - header carries min/max for filtering
+    t0, t1 = int(min(t)), int(max(t))
+    if numpy is not None:
+        payload = [ numpy.diff(numpy.asarray(t, dtype='q'), prepend=t0).astype('i').tobytes(),
+                    numpy.asarray(cols['status'], dtype='B').tobytes() ]
+        for name, typ, _ in COLUMNS[2:]:
+            v = numpy.asarray(cols[name], dtype='q')
+            payload.append(numpy.diff(v, prepend=0).astype(typ).tobytes())
+    else:
+        payload = [ array('i', [ b - a for a, b in zip([t0] + list(t[:-1]), t) ]).tobytes(),
+                    array('B', cols['status']).tobytes() ]
+        for name, typ, _ in COLUMNS[2:]:
+            v, mask = cols[name], (1 << (8 * array(typ).itemsize)) - 1
+            payload.append(array(typ, [v[0] & mask] + [ (b - a) & mask for a, b in zip(v, v[1:]) ]).tobytes())
+    payload = zlib.compress(b''.join(payload), 9)
+    device = device.encode('utf-8')
+    return BLOCK.pack(BLOCK_MAGIC, len(t), t0, t1, len(device), len(payload), zlib.crc32(payload)) \
+        + device + payload
+
+
+class Block:
+    """ block of history file - header fields and (still compressed) payload """
+
+    def __init__(self, device, rows, t0, t1, payload):
+        """ init """
+        self.device, self.rows, self.t0, self.t1, self.payload = device, rows, t0, t1, payload
+
+    def columns(self):
+        """ decompress and decode columns - {name: array} with t (timestamps) instead of dt """
+        raw, cols, off = zlib.decompress(self.payload), {}, 0
+        for name, typ, out in COLUMNS:
+            size = self.rows * array(typ).itemsize
+            cols[name] = self._decode(raw[off:off + size], name, typ, out)
+            off += size
+        cols['t'] = cols.pop('dt')
+        return cols
+
+    def _decode(self, buf, name, typ, out):
+        """ decode column from bytes buf """
+        if numpy is not None:
+            v = numpy.frombuffer(buf, dtype=typ)
+            if name == 'status': return v
+            if name == 'dt': return numpy.cumsum(v, dtype=out) + self.t0
+            # running sum in stored (unsigned) type wraps around, view as signed
+            return numpy.cumsum(v, dtype=typ).view(out)
+        v = array(typ)
+        v.frombytes(buf)
+        if name == 'status': return v
+        if name == 'dt': return array(out, accumulate(v, initial=self.t0))[1:]
+        mask = (1 << (8 * v.itemsize)) - 1
+        res = array(out)
+        res.frombytes(array(typ, accumulate(v, lambda a, b: (a + b) & mask)).tobytes())
+        return res
+
+
+def scan(m):
+    """ iterate complete blocks in (memory-mapped) history file m - (offset, header fields, end offset) """
+    off = len(MAGIC)
+    while off + BLOCK.size <= len(m):
+        magic, rows, t0, t1, dlen, plen, crc = BLOCK.unpack_from(m, off)
+        end = off + BLOCK.size + dlen + plen
+        if magic != BLOCK_MAGIC or end > len(m): return
+        yield off, (rows, t0, t1, dlen, plen, crc), end
+        off = end
+
+
+def blocks(path, device=None, since=None, until=None):
+    """ iterate blocks of history file (memory-mapped) - optionally only device and overlapping [since, until) """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC): return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC: raise ValueError('%s: not a signal history file' % path)
+            end = len(MAGIC)
+            for off, (rows, t0, t1, dlen, plen, crc), end in scan(m):
+                dev = m[off + BLOCK.size:off + BLOCK.size + dlen].decode('utf-8')
+                if device is not None and dev != device: continue
+                if since is not None and t1 < since: continue
+                if until is not None and t0 >= until: continue
+                payload = m[end - plen:end]
+                if zlib.crc32(payload) != crc:
+                    warnings.warn('%s: crc error in block at %d, skipped' % (path, off))
+                    continue
+                yield Block(dev, rows, t0, t1, payload)
+            if end != len(m): warnings.warn('%s: truncated or corrupted block at %d, ignored' % (path, end))
+
+
+def repair(path):
+    """ cut off torn (partial or crc error) block at the end of history file """
+    if not os.path.exists(path): return
+    with open(path, 'r+b') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            f.truncate(0)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC: raise ValueError('%s: not a signal history file' % path)
+            good = last = len(MAGIC)
+            for last, (_, _, _, _, plen, crc), good in scan(m): pass
+            # the last complete block may be torn too
+            if good > len(MAGIC) and zlib.crc32(m[good - plen:good]) != crc: good = last
+        if good != size:
+            warnings.warn('%s: torn block at %d cut off' % (path, good))
+            f.truncate(good)
+
+
+def samples(path, device=None, since=None, until=None):
+    """ iterate samples of history file as dicts (check_device() like result with 't') """
+    for block in blocks(path, device, since, until):
+        c = block.columns()
+        for i in range(block.rows):
+            t = int(c['t'][i])
+            if since is not None and t < since: continue
+            if until is not None and t >= until: continue
+            status = STATUS[c['status'][i]]
+            if status != 'ok':
+                yield {'t': t, 'signal': status, 'desc': status}
+                continue
+            yield dict([('t', t)] + [ (name, str(c[name][i])) for name, _, _ in COLUMNS[2:] ])
+
+
+def is_history(path):
+    """ check file magic """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class HistoryWriter:
+    """ records samples of one device - buffered, block appended to file every rows samples or seconds """
+
+    def __init__(self, path, device, rows=BLOCK_ROWS, seconds=FLUSH_SECONDS):
+        """ init """
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path, self.device, self.rows, self.seconds = path, device, rows, seconds
+        self.cols = { name: [] for name in ['t'] + [ c[0] for c in COLUMNS[1:] ] }
+        # last valid values (repeated for non-ok samples)
+        self.last = { name: 0 for name, _, _ in COLUMNS[2:] }
+
+    def append(self, sample, now):
+        """ add sample (check_device() result, no Q10 means error/nocon) taken at time now [epoch seconds] """
+        ok = bool(sample.get('Q10'))
+        # time went backwards (clock step) - start a new block
+        if self.cols['t'] and int(now) < self.cols['t'][-1]: self.flush()
+        self.cols['t'].append(int(now))
+        self.cols['status'].append(0 if ok else STATUS.index(sample.get('signal', 'error')))
+        for name, typ, _ in COLUMNS[2:]:
+            if ok:
+                lim = 1 << (8 * array(typ).itemsize - 1)
+                self.last[name] = max(-lim, min(lim - 1, int(sample[name])))
+            self.cols[name].append(self.last[name])
+        t = self.cols['t']
+        if len(t) >= self.rows or t[-1] - t[0] >= self.seconds: self.flush()
+
+    def flush(self):
+        """ append buffered samples as a block """
+        if not self.cols['t']: return
+        write(self.path, [encode_block(self.device, self.cols)])
+        for v in self.cols.values(): v.clear()
+
+    def close(self):
+        """ flush buffered samples """
+        self.flush()
+
+
+def write(path, data):
+    """ append encoded blocks to history file (file magic is written to a new file, torn block is cut off) """
+    repair(path)
+    with open(path, 'ab') as f:
+        if not f.tell(): f.write(MAGIC)
+        for d in data: f.write(d)
+
+
+def concat(chunks):
+    """ concatenate column chunks (arrays or numpy arrays) """
+    if numpy is not None: return numpy.concatenate(chunks)
+    res = array(chunks[0].typecode)
+    for c in chunks: res.extend(c)
+    return res
+
+
+def select(cols, since, until):
+    """ rows of decoded block columns in [since, until) """
+    t = cols['t']
+    if numpy is not None:
+        sel = numpy.ones(len(t), dtype=bool)
+        if since is not None: sel &= t >= since
+        if until is not None: sel &= t < until
+        return { k: v[sel] for k, v in cols.items() }
+    sel = [ (since is None or x >= since) and (until is None or x < until) for x in t ]
+    return { k: array(v.typecode, compress(v, sel)) for k, v in cols.items() }
+
+
+def export(src, dst, device=None, since=None, until=None, rows=EXPORT_ROWS):
+    """ export samples of src (optionally device, time range) to new history file dst - re-blocked per rows """
+
+    def encoded():
+        # column chunks per device - {device: [rows, {name: [chunk, ...]}]}
+        buf = {}
+        for block in blocks(src, device, since, until):
+            c = block.columns()
+            # only blocks on the range boundary are filtered per row
+            if (since is not None and block.t0 < since) or (until is not None and block.t1 >= until):
+                c = select(c, since, until)
+            n, chunks = buf.setdefault(block.device, [0, { k: [] for k in c }])
+            for k, v in c.items(): chunks[k].append(v)
+            n += len(c['t'])
+            while n >= rows:
+                cols = { k: concat(v) for k, v in chunks.items() }
+                yield encode_block(block.device, { k: v[:rows] for k, v in cols.items() })
+                chunks = { k: [v[rows:]] for k, v in cols.items() }
+                n -= rows
+            buf[block.device] = [n, chunks]
+        for dev, (n, chunks) in buf.items():
+            if n: yield encode_block(dev, { k: concat(v) for k, v in chunks.items() })
+
+    if os.path.exists(dst): os.remove(dst)
+    write(dst, encoded())
+
+
+def import_file(src, dst):
+    """ import (append) all blocks of history file src to dst - blocks are copied (streamed) as they are """
+    write(dst, ( encode_raw(b) for b in blocks(src) ))
+
+
+def encode_raw(block):
+    """ block -> bytes (without re-encoding payload) """
+    device = block.device.encode('utf-8')
+    return BLOCK.pack(BLOCK_MAGIC, block.rows, block.t0, block.t1, len(device), len(block.payload),
+                      zlib.crc32(block.payload)) + device + block.payload
+
+
+def parse_time(txt):
+    """ command line time - epoch seconds or YYYY-MM-DD[THH:MM] (UTC) """
+    if txt is None: return None
+    if txt.isdigit(): return int(txt)
+    return calendar.timegm(time.strptime(txt, '%Y-%m-%dT%H:%M' if 'T' in txt else '%Y-%m-%d'))
+
+
+def main():
+    """ main - history file tools """
+    parser = argparse.ArgumentParser(description='wifi signal history')
+    parser.add_argument('cmd', choices=['info', 'csv', 'export', 'import'],
+                        help='info - blocks summary, csv - dump samples, export - filtered copy to dst, '
+                             'import - append src to dst')
+    parser.add_argument('src', help='history file')
+    parser.add_argument('dst', nargs='?', help='destination history file (export, import)')
+    parser.add_argument('--device', help='device url (default: all)')
+    parser.add_argument('--since', help='from time (epoch seconds or YYYY-MM-DD[THH:MM] UTC)')
+    parser.add_argument('--until', help='until time (epoch seconds or YYYY-MM-DD[THH:MM] UTC)')
+    args = parser.parse_args()
+    since, until = parse_time(args.since), parse_time(args.until)
+
+    if args.cmd in ('export', 'import') and not args.dst: parser.error('%s requires dst' % args.cmd)
+    if args.cmd == 'info':
+        n = size = 0
+        for b in blocks(args.src, args.device, since, until):
+            n, size = n + b.rows, size + BLOCK.size + len(b.device.encode('utf-8')) + len(b.payload)
+            print('%s  %s .. %s  rows %5d  bytes %6d' % (b.device, time.strftime('%Y-%m-%d %H:%M', time.gmtime(b.t0)),
+                  time.strftime('%Y-%m-%d %H:%M', time.gmtime(b.t1)), b.rows, len(b.payload)))
+        print('rows %d  bytes %d (%.2f per row)' % (n, size, size / n if n else 0))
+    elif args.cmd == 'csv':
+        names = [ c[0] for c in COLUMNS[2:] ]
+        print(','.join(['t', 'device', 'status'] + names))
+        for b in blocks(args.src, args.device, since, until):
+            c = b.columns()
+            for i in range(b.rows):
+                t = int(c['t'][i])
+                if (since is not None and t < since) or (until is not None and t >= until): continue
+                status = c['status'][i]
+                vals = [ str(c[name][i]) if not status else '' for name in names ]
+                print(','.join([str(t), b.device, STATUS[status]] + vals))
+    elif args.cmd == 'export':
+        export(args.src, args.dst, args.device, since, until)
+    else:
+        import_file(args.src, args.dst)
+
+
+# MAIN
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+"""
+    Rollups of wifi signal metrics - per device min/max/mean/percentile sketch and outage seconds
+    in 1 minute / 1 hour / 1 day buckets (local time aligned, TZ environment variable applies) stored in sqlite
+
+    Samples are accumulated in memory for the actual minute only. When the minute is over the accumulator
+    is merged into the minute, hour and day rows (so the coarse rows are always up to date and months of
+    data can be queried from a few thousand rows). The percentile sketch is a histogram (metric value
+    bins -> count) which merges by adding counts. Minute rows are kept for the last KEEP_DAYS days only
+    (whole days), hour/day rows can be rebuilt in bulk from the kept minute rows.
+
+    usage: wifi_rollup.py [--period 60|3600|86400] [--device url] [--metric SN] [--rebuild] db
+"""
+
+import sys, os, sqlite3, argparse, time, warnings
+from array import array
+from collections import Counter
+
+# rollup periods [seconds] - minute, hour, day
+PERIODS = (60, 3600, 86400)
+
+# minute rollups retention [days]
+KEEP_DAYS = 2
+
+# max minute accumulators kept while db is not writable (busy, error)
+PENDING = 60
+
+# rolled up metrics (sample keys, see SystemTrayIcon.check_device() and callculate())
+METRICS = ('signal', 'noise', 'SNR', 'SN', 'Q10')
+
+# sketch bin width per metric (default 1)
+BIN_WIDTH = {'Q10': 10}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup (
+    device TEXT, period INTEGER, start INTEGER, metric TEXT,
+    n INTEGER, vmin INTEGER, vmax INTEGER, vsum INTEGER, sketch BLOB,
+    PRIMARY KEY (device, period, start, metric)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS outage (
+    device TEXT, period INTEGER, start INTEGER, samples INTEGER, seconds INTEGER,
+    PRIMARY KEY (device, period, start)
+) WITHOUT ROWID;
+"""
+
+
+def bucket(t, period):
+    """ start of period bucket with time t [epoch seconds] - aligned to local time (midnight for days) """
+    lt = time.localtime(t)
+    if period < PERIODS[-1]: return t - (t + lt.tm_gmtoff) % period
+    return int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+
+def sketch_pack(hist):
+    """ histogram {bin: count} -> blob (int32 pairs bin, count sorted by bin) """
+    return array('i', [ v for b in sorted(hist) for v in (b, hist[b]) ]).tobytes()
+
+
+def sketch_unpack(blob):
+    """ blob -> histogram Counter {bin: count} """
+    a = array('i')
+    a.frombytes(blob)
+    return Counter(dict(zip(a[0::2], a[1::2])))
+
+
+def sketch_quantile(hist, q, width=1):
+    """ q-quantile (0..1) of histogram {bin: count} - lower edge of the bin """
+    n = sum(hist.values())
+    if not n: return None
+    rank, acc = q * (n - 1), 0
+    for b in sorted(hist):
+        acc += hist[b]
+        if acc > rank: return b * width
+    return max(hist) * width
+
+
+def merge(a, b):
+    """ merge metric rollups [n, vmin, vmax, vsum, hist] - a is updated """
+    a[0] += b[0]
+    a[1] = min(a[1], b[1])
+    a[2] = max(a[2], b[2])
+    a[3] += b[3]
+    a[4].update(b[4])
+    return a
+
+
+class Rollup:
+    """ incrementally maintained rollups of one device """
+
+    def __init__(self, path, device, interval, metrics=METRICS, keep=KEEP_DAYS, timeout=5.0):
+        """ init - sqlite db path, device id (url), sample interval [seconds] (outage time of one sample),
+            minute rollups retention [days], db lock timeout [seconds] """
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=timeout)
+        # pruned pages are returned to the filesystem (applies to a new db)
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.executescript(SCHEMA)
+        self.device, self.interval, self.metrics, self.keep = device, interval, metrics, keep
+        # day of the last minute rows pruning
+        self.pruned = None
+        # actual minute accumulator - start, {metric: [n, vmin, vmax, vsum, hist]}, [samples, outage seconds]
+        self.start, self.acc, self.out = None, {}, [0, 0]
+        # minute accumulators (start, acc, out) not written yet - db was locked or failed
+        self.pending = []
+
+    def add(self, sample, now):
+        """ add sample (dict with metric values, no Q10 means outage) taken at time now [epoch seconds] """
+        start = bucket(int(now), PERIODS[0])
+        if start != self.start:
+            self.flush()
+            self.start = start
+        self.out[0] += 1
+        if not sample.get('Q10'):
+            self.out[1] += self.interval
+            return
+        for m in self.metrics:
+            try:
+                v = int(sample[m])
+            except (KeyError, ValueError):
+                continue
+            a = self.acc.get(m)
+            if a is None:
+                a = self.acc[m] = [0, v, v, 0, Counter()]
+            merge(a, [1, v, v, v, {v // BIN_WIDTH.get(m, 1): 1}])
+
+    def flush(self):
+        """ merge actual minute accumulator (and pending ones) into minute/hour/day rows - on db error
+            (locked by rebuild etc.) the accumulators are kept pending and retried with the next flush """
+        if self.start is not None and self.out[0]:
+            self.pending.append((self.start, self.acc, self.out))
+            del self.pending[:-PENDING]
+        self.acc, self.out = {}, [0, 0]
+        if not self.pending: return
+        try:
+            with self.db:
+                for minute in self.pending: self._write(*minute)
+                self.prune(self.pending[-1][0])
+        except sqlite3.Error as e:
+            warnings.warn('%s: rollups not written (%d minutes pending): %s' % (self.device, len(self.pending), e))
+            return
+        self.pending = []
+
+    def _write(self, minute, acc, out):
+        """ merge minute accumulator into minute/hour/day rows (within transaction) """
+        for period in PERIODS:
+            start = bucket(minute, period)
+            key = (self.device, period, start)
+            for m, a in acc.items():
+                row = self.db.execute('SELECT n, vmin, vmax, vsum, sketch FROM rollup WHERE device=? AND '
+                                      'period=? AND start=? AND metric=?', key + (m,)).fetchone()
+                r = merge([*row[:4], sketch_unpack(row[4])], a) if row else a
+                self.db.execute('INSERT OR REPLACE INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                key + (m, r[0], r[1], r[2], r[3], sketch_pack(r[4])))
+            self.db.execute('INSERT INTO outage VALUES (?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET '
+                            'samples=samples+excluded.samples, seconds=seconds+excluded.seconds',
+                            key + tuple(out))
+
+    def prune(self, minute):
+        """ delete minute rows older than keep days before minute (once a day, whole days are kept) """
+        day = bucket(minute, PERIODS[-1])
+        if day == self.pruned: return
+        # local midnight keep days ago (noon avoids DST shifts)
+        cutoff = bucket(day + 43200 - self.keep * PERIODS[-1], PERIODS[-1])
+        for table in ('rollup', 'outage'):
+            self.db.execute('DELETE FROM %s WHERE device=? AND period=? AND start<?' % table,
+                            (self.device, PERIODS[0], cutoff))
+        self.db.execute('PRAGMA incremental_vacuum')
+        self.pruned = day
+
+    def close(self):
+        """ flush and close db """
+        self.flush()
+        self.db.close()
+
+    def rebuild(self, periods=PERIODS[1:]):
+        """ rebuild (bulk) coarser rollups from minute rows - only buckets covered by kept minute rows """
+        with self.db:
+            for period in periods:
+                rows, out = {}, {}
+                for start, m, n, vmin, vmax, vsum, sketch in self.db.execute(
+                        'SELECT start, metric, n, vmin, vmax, vsum, sketch FROM rollup WHERE device=? AND period=?',
+                        (self.device, PERIODS[0])):
+                    key, r = (bucket(start, period), m), [n, vmin, vmax, vsum, sketch_unpack(sketch)]
+                    if key in rows: merge(rows[key], r)
+                    else: rows[key] = r
+                for start, samples, seconds in self.db.execute(
+                        'SELECT start, samples, seconds FROM outage WHERE device=? AND period=?',
+                        (self.device, PERIODS[0])):
+                    o = out.setdefault(bucket(start, period), [0, 0])
+                    o[0], o[1] = o[0] + samples, o[1] + seconds
+                # older buckets (minute rows pruned) are kept as they are
+                for table in ('rollup', 'outage'):
+                    self.db.executemany('DELETE FROM %s WHERE device=? AND period=? AND start=?' % table,
+                                        [ (self.device, period, start) for start in out ])
+                self.db.executemany('INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                    (self.device, period, start, m, r[0], r[1], r[2], r[3], sketch_pack(r[4]))
+                    for (start, m), r in rows.items() ])
+                self.db.executemany('INSERT INTO outage VALUES (?, ?, ?, ?, ?)', [
+                    (self.device, period, start, o[0], o[1]) for start, o in out.items() ])
+
+    def query(self, period, since=0, until=None, quantiles=(.5, .95)):
+        """ rollup rows of period in [since, until) - list of {start, samples, outage, metric: {min, max, ...}} """
+        until = sys.maxsize if until is None else until
+        res = {}
+        for start, samples, seconds in self.db.execute(
+                'SELECT start, samples, seconds FROM outage WHERE device=? AND period=? AND start>=? AND start<? '
+                'ORDER BY start', (self.device, period, since, until)):
+            res[start] = {'start': start, 'samples': samples, 'outage': seconds}
+        for start, m, n, vmin, vmax, vsum, sketch in self.db.execute(
+                'SELECT start, metric, n, vmin, vmax, vsum, sketch FROM rollup WHERE device=? AND period=? '
+                'AND start>=? AND start<?', (self.device, period, since, until)):
+            hist, width = sketch_unpack(sketch), BIN_WIDTH.get(m, 1)
+            r = {'n': n, 'min': vmin, 'max': vmax, 'mean': vsum / n}
+            r.update(('p%d' % (q * 100), sketch_quantile(hist, q, width)) for q in quantiles)
+            res.setdefault(start, {'start': start})[m] = r
+        return [ res[start] for start in sorted(res) ]
+
+
+def main():
+    """ main - print rollup report """
+    parser = argparse.ArgumentParser(description='wifi signal rollups report')
+    parser.add_argument('db', help='rollup sqlite db')
+    parser.add_argument('--period', type=int, choices=PERIODS, default=PERIODS[-1], help='rollup period [seconds]')
+    parser.add_argument('--device', help='device url (default: all)')
+    parser.add_argument('--metric', default='SN', choices=METRICS, help='reported metric')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild hour/day rollups from minute rollups')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db): parser.error('%s: no such db' % args.db)
+    db = sqlite3.connect(args.db)
+    db.executescript(SCHEMA)
+    devices = [args.device] if args.device else [ d for d, in db.execute('SELECT DISTINCT device FROM outage') ]
+    db.close()
+    for device in devices:
+        rollup = Rollup(args.db, device, 0)
+        if args.rebuild: rollup.rebuild()
+        print('%s %s' % (device, args.metric))
+        for r in rollup.query(args.period):
+            m = r.get(args.metric)
+            stat = 'min %(min)4d max %(max)4d mean %(mean)6.1f p50 %(p50)4d p95 %(p95)4d' % m if m else '-'
+            print('  %s  samples %5d outage %6ds  %s' % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(r['start'])), r['samples'], r['outage'], stat))
+        rollup.close()
+
+
+# MAIN
+#
+if __name__ == '__main__':
+    main()